@@ -1,21 +1,35 @@
 
-import base64
+import asyncio
+from collections import OrderedDict
 from functools import wraps
-import json
+from itertools import chain
+import hashlib
 import logging
 import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
 from logging import getLogger
-from typing import List, Tuple
-from flask import Flask, request, render_template_string, g, Response
-from elasticsearch import Elasticsearch
-import nltk
-nltk.download('stopwords')
-from nltk.corpus import stopwords
+from typing import List, Optional, Tuple
+from quart import Quart, request, Response, make_response
+from elasticsearch import AsyncElasticsearch
+from elastic_transport import OrjsonSerializer
+import msgpack
+import orjson
+import redis.asyncio as redis
+
+try:
+    # SIMD-accelerated drop-in for the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from llm import ChatGPTTupleArrayFetcher, SearchHighlightResponse
+from llm import ChatGPTTupleArrayFetcher, SearchHighlightResponse, close_openai_client
+from text_utils import remove_stopwords
 
 def setup_logging():
     # Configure root logger
@@ -27,12 +41,18 @@ def setup_logging():
 
 setup_logging()
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 CLOUD_ID = os.environ.get('ELASTIC_CLOUD_ID')
 USERNAME = os.environ.get('ELASTIC_USERNAME')
 PASSWORD = os.environ.get('ELASTIC_PASSWORD')
+REDIS_URL = os.environ.get('REDIS_URL')
+HISTORY_TTL_SECONDS = 3600
+LLM_RESULT_TTL_SECONDS = 86400
 JUDGMENT_PAGE_URL = "https://thejudgements.in/searchResult?url="
+ES_INDEX = "doc_zeta"
+HIGHLIGHT_OPEN = "<mark style='background-color: #ffff00; font-weight: bold;'>"
+HIGHLIGHT_CLOSE = "</mark>"
 
 def check_auth(username, password):
     return (
@@ -49,30 +69,40 @@ def authenticate():
 
 def requires_auth(f):
     @wraps(f)
-    def decorated(*args, **kwargs):
+    async def decorated(*args, **kwargs):
         auth = request.authorization
         if not auth or not check_auth(auth.username, auth.password):
             return authenticate()
-        return f(*args, **kwargs)
+        return await f(*args, **kwargs)
     return decorated
 
+_es = None
+
 def get_es():
-    if 'es' not in g:
-        g.es = Elasticsearch(
+    # One client per process so its connection pool and TLS sessions are reused across requests
+    global _es
+    if _es is None:
+        _es = AsyncElasticsearch(
             cloud_id=CLOUD_ID,
             basic_auth=(USERNAME, PASSWORD),
             request_timeout=30,
             max_retries=3,
-            retry_on_timeout=True
+            retry_on_timeout=True,
+            http_compress=True,
+            serializer=OrjsonSerializer()
         )
-    return g.es
-
-STOPWORDS = set(stopwords.words('english'))
+    return _es
 
-def remove_stopwords(text):
-    return ' '.join(word for word in text.split() if word.lower() not in STOPWORDS)
+@app.after_serving
+async def close_clients():
+    if _es is not None:
+        await _es.close()
+    if REDIS_CLIENT is not None:
+        await REDIS_CLIENT.aclose()
+    await close_openai_client()
 
 class Term:
+    __slots__ = ("text", "no_stop")
     text: str
     no_stop: str
 
@@ -90,6 +120,7 @@ class Term:
         return term
 
 class SearchHighlightResponseWithNoStop:
+    __slots__ = ("search", "highlight")
     search: list[list[Term]]
     highlight: list[Term]
 
@@ -118,113 +149,168 @@ class SearchHighlightResponseWithNoStop:
 
 def encode_queries(queries: List[Tuple[str, SearchHighlightResponseWithNoStop]]) -> str:
     """Encodes a list of search highlight responses with no stop to a URL-safe string"""
-    serializable = [(query, resp.to_dict()) for query, resp in queries]
-    json_str = json.dumps({"resp": serializable}, separators=(",", ":"))
-    return base64.urlsafe_b64encode(json_str.encode()).decode()
+    packed = msgpack.packb([(query, resp.to_dict()) for query, resp in queries], use_bin_type=True)
+    return base64.urlsafe_b64encode(packed).decode()
 
 def decode_queries(encoded_str: str) -> List[Tuple[str, SearchHighlightResponseWithNoStop]]:
     """Decodes the URL-safe string back to a list of search highlight responses with no stop"""
-    json_str = base64.urlsafe_b64decode(encoded_str.encode()).decode()
-    data = json.loads(json_str)
-    return [(query, SearchHighlightResponseWithNoStop.from_dict(resp)) for query, resp in data["resp"]]
+    data = msgpack.unpackb(base64.urlsafe_b64decode(encoded_str.encode()), raw=False)
+    return [(query, SearchHighlightResponseWithNoStop.from_dict(resp)) for query, resp in data]
+
+class LRUCache:
+    """Thread-safe in-process LRU map whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+class SessionStore:
+    """Hands out the token a page carries to continue its query history.
+
+    With REDIS_URL configured the history stays server-side and the token is an opaque key
+    every worker can resolve. Without it the token is the encoded history itself, as the
+    form carried before, so multi-turn search still works whichever worker gets the request.
+    """
+
+    def __init__(self, redis_client: Optional[redis.Redis] = None, ttl: int = HISTORY_TTL_SECONDS):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    async def get(self, token: str) -> List[Tuple[str, SearchHighlightResponseWithNoStop]]:
+        if not token:
+            return []
+        blob = token
+        if self.redis is not None:
+            blob = await self.redis.get(f"history:{token}")
+            if blob is None:
+                getLogger().info(f"history token {token} not found or expired")
+                return []
+        try:
+            return decode_queries(blob)
+        except Exception as e:
+            # e.g. an entry written by an older wire format, or a mangled form field
+            getLogger().info(f"failed to decode history for token {token}: {e}")
+            return []
+
+    async def put(self, history: List[Tuple[str, SearchHighlightResponseWithNoStop]]) -> str:
+        if not history:
+            return ""
+        if self.redis is None:
+            return encode_queries(history)
+        token = uuid.uuid4().hex
+        await self.redis.set(f"history:{token}", encode_queries(history), ex=self.ttl)
+        return token
+
+    async def touch(self, token: str) -> bool:
+        """Restarts a live token's TTL; False once it has expired"""
+        if not token or self.redis is None:
+            # An inline history never expires
+            return True
+        return bool(await self.redis.expire(f"history:{token}", self.ttl))
+
+    def etag(self, digest: str, token: str) -> str:
+        """ETag for a page handing out token; only a server-side token, which can expire, rides along for touch()"""
+        return f"{digest}.{token}" if self.redis is not None else digest
+
+class LLMResultCache:
+    """Parsed LLM results, shared through Redis when REDIS_URL is configured so every worker and
+    restart reuses them, otherwise kept in an in-process LRU.
+
+    Values are the fetcher's plain lists/dicts; Redis holds them as JSON text, which the
+    string-decoding client hands back as is.
+    """
+
+    def __init__(self, redis_client: Optional[redis.Redis] = None, ttl: int = LLM_RESULT_TTL_SECONDS, maxsize: int = 8192):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+
+    @staticmethod
+    def _redis_key(key: tuple) -> str:
+        return "llm:" + hashlib.blake2b(msgpack.packb(list(key)), digest_size=16).hexdigest()
+
+    async def get(self, key: tuple):
+        if self.redis is None:
+            return self.local.get(key)
+        blob = await self.redis.get(self._redis_key(key))
+        return orjson.loads(blob) if blob is not None else None
+
+    async def set(self, key: tuple, value):
+        if self.redis is None:
+            self.local.set(key, value)
+        else:
+            await self.redis.set(self._redis_key(key), orjson.dumps(value), ex=self.ttl)
 
+REDIS_CLIENT = redis.Redis(connection_pool=redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True)) if REDIS_URL else None
 
-def build_query(queries: list[list[list[Term]]], highlights: list[Term], plain_query: str):
-    functions = [
+SESSION_STORE = SessionStore(REDIS_CLIENT)
+# The LLM call dominates the latency and cost of a search
+LLM_RESULT_CACHE = LLMResultCache(REDIS_CLIENT)
+
+
+# Clause templates for build_query. Only the phrases vary, and they are JSON-encoded with orjson
+# before being spliced in, so each search skips building and re-serializing dicts.
+_HIGHLIGHT_PHRASE_TMPL = b'{"match_phrase":{"document_text":{"query":%s,"slop":20,"boost":%d}}}'
+_FILTER_PHRASE_TMPL = b'{"match_phrase":{"document_text":{"query":%s,"slop":20}}}'
+_FILTER_GROUP_TMPL = b'{"bool":{"should":[%s],"minimum_should_match":1}}'
+
+# Everything in the search body except the slots build_query fills in
+_SKELETON = {
+  "query": {
+    "function_score": {
+      "query": {
+        # Scoring comes only from the functions (boost_mode "replace"), so matching runs in
+        # filter context: no per-clause scoring, and Elasticsearch can cache the clauses
+        "bool": {
+          "filter": "@filter@"
+        }
+      },
+      "functions": [
         {
           "gauss": {
             "document_date": {
-              "origin": "now",
+              "origin": "@origin@",
               "scale": "300d",
               "decay": 0.99
             }
           }
         }
-    ]
-    
-    highlight_functions = []
-    for phrases in queries[-1]:
-        for phrase in phrases:
-            highlight_functions.extend(
-                [
-                    {
-                "match_phrase": {
-                    "document_text": {
-                    "query": phrase.text,
-                    "slop": 20,
-                    "boost": 10
-                    }
-                }
-                },
-                {
-                "match_phrase": {
-                    "document_text": {
-                    "query": phrase.no_stop,
-                    "slop": 20,
-                    "boost": 5
-                    }
-                }
-                }
-                ]
-            )
-    for highlight in highlights:
-        if not highlight.no_stop:
-            continue
-        highlight_functions.extend(
-            [
-                {
-                    "match_phrase": {
-                        "document_text": {
-                            "query": highlight.no_stop,
-                            "slop": 20,
-                            "boost": 1
-                            }
-                        }
-                }
-            ]
-        )
-    filter = []
-    for query in queries:
-        for phrases in query:
-            filter.append(
-                    {
-                    "bool": {
-                        "should": [
-                        {
-                            "match_phrase": {
-                            "document_text": {
-                                "query": phrase.no_stop,
-                                "slop": 20
-                            }
-                            }
-                        } for phrase in phrases
-                        ],
-                        "minimum_should_match": 1
-                    }
-                    }
-            )
-    return {
-  "query": {
-    "function_score": {
-      "query": {
-        "bool": {
-          "must": filter
-        }
-      },
-      "functions": functions,
+      ],
       "score_mode": "multiply",
       "boost_mode": "replace"
     }
   },
-    "suggest": {
-    "text": plain_query,
+  "suggest": {
+    "text": "@text@",
     "spellcheck": {
-        "term": {
-            "field": "document_text",
-            "suggest_mode": "always"
-        }
+      "term": {
+        "field": "document_text",
+        "suggest_mode": "always"
+      }
     }
-    },
+  },
   "highlight": {
     "fields": {
       "document_text": {
@@ -235,18 +321,92 @@ def build_query(queries: list[list[list[Term]]], highlights: list[Term], plain_q
           "document_text"
         ],
         "highlight_query": {
-            "bool": {
-                "should": highlight_functions
-            }
-            }
+          "bool": {
+            "should": "@should@"
+          }
+        }
       }
     },
     "fragmenter": "score_ordered",
-    "require_field_match": True
+    "require_field_match": True,
+    # Fragments come back already wrapped in the page's highlight markup
+    "pre_tags": [HIGHLIGHT_OPEN],
+    "post_tags": [HIGHLIGHT_CLOSE]
   },
   "size": 50
 }
 
+def _skeleton_template(skeleton: dict) -> bytes:
+    """Serializes the skeleton once, turning its slot markers into %s placeholders"""
+    return (
+        orjson.dumps(skeleton)
+        .replace(b"%", b"%%")
+        .replace(b'"@filter@"', b"[%s]")
+        .replace(b'"@origin@"', b"%s")
+        .replace(b'"@text@"', b"%s")
+        .replace(b'"@should@"', b"[%s]")
+    )
+
+_BODY_TMPL = _skeleton_template(_SKELETON)
+_BODY_NO_SUGGEST_TMPL = _skeleton_template({key: value for key, value in _SKELETON.items() if key != "suggest"})
+
+def decay_origin() -> str:
+    # Decay from the start of the current UTC day rather than "now": queries that depend on the
+    # current time are never served from the shard request cache, and the body stays identical all day
+    return datetime.now(timezone.utc).date().isoformat()
+
+def build_query(queries: list[list[list[Term]]], highlights: list[Term], plain_query: str, want_spellcheck: bool = True) -> bytes:
+    """Builds the serialized Elasticsearch search body, with the spellcheck suggester if want_spellcheck"""
+    # Refined searches repeat phrases across turns and a phrase often has no stopwords to strip;
+    # keep one highlight clause per distinct query string, at the highest boost it was given.
+    # 10 is the top boost and 1 the bottom one, so only the middle tier needs a comparison.
+    boosts = {}
+    for phrases in queries[-1]:
+        for phrase in phrases:
+            boosts[phrase.text] = 10
+            if boosts.get(phrase.no_stop, 0) < 5:
+                boosts[phrase.no_stop] = 5
+    for highlight in highlights:
+        if highlight.no_stop:
+            boosts.setdefault(highlight.no_stop, 1)
+    highlight_functions = [_HIGHLIGHT_PHRASE_TMPL % (orjson.dumps(query), boost) for query, boost in boosts.items()]
+    filter = []
+    seen_groups = set()
+    for query in queries:
+        for phrases in query:
+            # dict.fromkeys keeps the first-seen order so equal histories serialize identically
+            group = tuple(dict.fromkeys(phrase.no_stop for phrase in phrases))
+            if group in seen_groups:
+                continue
+            seen_groups.add(group)
+            should = b",".join([_FILTER_PHRASE_TMPL % orjson.dumps(no_stop) for no_stop in group])
+            filter.append(_FILTER_GROUP_TMPL % should)
+    if not want_spellcheck:
+        return _BODY_NO_SUGGEST_TMPL % (b",".join(filter), orjson.dumps(decay_origin()), b",".join(highlight_functions))
+    return _BODY_TMPL % (
+        b",".join(filter), orjson.dumps(decay_origin()), orjson.dumps(plain_query), b",".join(highlight_functions)
+    )
+
+def get_query_body(queries: List[Tuple[str, SearchHighlightResponseWithNoStop]], want_spellcheck: bool = True) -> bytes:
+    """Returns the serialized Elasticsearch body for the history"""
+    # Not memoised: a key covering the whole history costs about as much as the byte templates,
+    # and cached_search already answers identical bodies without a round trip
+    query_text, last = queries[-1]
+    return build_query([query.search for _, query in queries], last.highlight, query_text, want_spellcheck)
+
+SEARCH_RESPONSE_CACHE = LRUCache(1024, ttl=60)
+# Spelling corrections by lowercased query; the suggester's tokens are lowercased by the analyzer anyway
+SPELLCHECK_CACHE = LRUCache(16384, ttl=86400)
+
+async def cached_search(es, body: bytes):
+    """Runs the search unless the identical body was answered within the last minute"""
+    key = hashlib.blake2b(body, digest_size=16).digest()
+    response = SEARCH_RESPONSE_CACHE.get(key)
+    if response is None:
+        response = await es.search(index=ES_INDEX, body=body, request_cache=True)
+        SEARCH_RESPONSE_CACHE.set(key, response)
+    return response
+
 def get_corrected_query(response, query):
     suggestions = response.get("suggest", {}).get("spellcheck", [])
 
@@ -263,18 +423,8 @@ def get_corrected_query(response, query):
     return corrected_query
 
 def get_snippets(highlights):
-    all_snippets = []
-
-    for fragments in highlights.values():
-        all_snippets.extend(fragments)
-
-    # Highlight <em> tags with styling
-    formatted_snippets = [
-        snippet.replace("<em>", "<mark style='background-color: #ffff00; font-weight: bold;'>").replace("</em>", "</mark>")
-        for snippet in all_snippets
-    ]
-
-    return formatted_snippets
+    # Elasticsearch already tags matches with HIGHLIGHT_OPEN/CLOSE; lazily, as the template consumes the snippets exactly once
+    return chain.from_iterable(highlights.values())
 
 def get_document_url(hit):
     url = hit["_source"].get("document_url", "")
@@ -282,49 +432,146 @@ def get_document_url(hit):
         return url
     return f"{JUDGMENT_PAGE_URL}{url}"
 
+def iter_results(response):
+    """Yields the template's view of each hit as the page is streamed out"""
+    # msearch reports per-search failures in place of hits
+    for hit in response.get("hits", {}).get("hits", []):
+        highlights_res = hit.get("highlight", {})
+        snippets = get_snippets(highlights_res)
+        document_url = get_document_url(hit)
+        yield {
+            "score": hit["_score"],
+            "date": hit["_source"].get("document_date", "Date not available"),
+            "case_name": hit["_source"].get("case_name", "Case name not available"),
+            "document_url": document_url,
+            "snippets": snippets
+        }
+
+async def buffered(chunks, size: int = 16384):
+    """Coalesces Jinja's per-expression output into larger chunks for the ASGI server"""
+    buffer = []
+    length = 0
+    async for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+async def search_turns(es, queries: List[Tuple[str, SearchHighlightResponseWithNoStop]]):
+    """Runs the search as of every turn of the history in one msearch round trip"""
+    searches = []
+    for i in range(len(queries)):
+        searches.append({"index": ES_INDEX, "request_cache": True})
+        # Only the current turn's "Did you mean" is shown, so replayed turns skip the suggester
+        searches.append(get_query_body(queries[:i + 1], want_spellcheck=False))
+    responses = (await es.msearch(searches=searches))["responses"]
+    for (text, _), response in zip(queries, responses):
+        if "error" in response:
+            getLogger().info(f"msearch failed for turn '{text}': {response['error']}")
+    return responses
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Pages hold per-user history, so only the browser may keep them, and only after revalidating
+SEARCH_CACHE_CONTROL = "private, max-age=0, must-revalidate"
+
+_llm = None
+
 def get_llm():
-    if 'llm' not in g:
-        g.llm = ChatGPTTupleArrayFetcher()
-    return g.llm
+    # Shared like the ES client; the fetcher holds no per-request state
+    global _llm
+    if _llm is None:
+        _llm = ChatGPTTupleArrayFetcher(cache=LLM_RESULT_CACHE)
+    return _llm
 
 @app.route("/", methods=["GET", "POST"])
 @requires_auth
-def search():
+async def search():
     results = []
+    previous_turns = []
     es = get_es()
     llm = get_llm()
     corrected_query = ""
-    previous_queries_encoded = request.values.get("previous_queries_encoded", encode_queries([]))
-    query_text = request.values.get("new_query_text", "")
+    values = await request.values
+    replay = values.get("replay") == "all"
+    history_token = values.get("history_token", "")
+    query_text = values.get("new_query_text", "")
     display_query_text = ""
     if request.method == "POST":
-        query_text = request.form["new_query_text"]
-        previous_queries_encoded = request.form.get("previous_queries_encoded", encode_queries([]))
+        form = await request.form
+        query_text = form["new_query_text"]
+        history_token = form.get("history_token", "")
+    # Identical requests render the same page; the day is included so scores decayed from the
+    # current date get revalidated. With server-side history the ETag also carries the token the
+    # page hands out, since a cached copy is only usable while that token is still stored.
+    etag = hashlib.blake2b(
+        f"{history_token}|{query_text}|{replay}|{decay_origin()}".encode(), digest_size=12
+    ).hexdigest()
+    matching_tokens = [
+        page_token for digest, _, page_token in (tag.partition(".") for tag in request.if_none_match.as_set())
+        if digest == etag
+    ]
+    if request.method in ("GET", "HEAD"):
+        for page_token in matching_tokens:
+            if await SESSION_STORE.touch(page_token):
+                # A 304 carries the validators and caching directives the 200 would have
+                not_modified = Response(status=304)
+                del not_modified.headers["Content-Type"]
+                not_modified.set_etag(SESSION_STORE.etag(etag, page_token))
+                not_modified.headers["Cache-Control"] = SEARCH_CACHE_CONTROL
+                return not_modified
+    elif matching_tokens or request.if_none_match.star_tag:
+        # RFC 9110: a matching If-None-Match on anything but GET/HEAD is a failed precondition
+        return Response(status=412)
     if query_text:
-        queries = decode_queries(previous_queries_encoded)
-        res = llm.fetch_search_highlight(query_text)
+        queries = await SESSION_STORE.get(history_token)
+        previous_search = None
+        if replay and queries:
+            # Earlier turns are already known, so replay them while waiting on the LLM
+            previous_search = asyncio.create_task(search_turns(es, list(queries)))
+
+        def warm_es():
+            # Make sure a warm keep-alive connection is ready for the search after the LLM call
+            run_in_background(es.options(request_timeout=5).ping())
+
+        try:
+            res = await llm.fetch_search_highlight(query_text, on_llm_request=warm_es if previous_search is None else None)
+        except BaseException:
+            if previous_search is not None:
+                previous_search.cancel()
+            raise
         if res is None:
             res = SearchHighlightResponse([[query_text]], [query_text])
         res_with_no_stop = SearchHighlightResponseWithNoStop.from_search_highlight_response(res)
         queries.append((query_text, res_with_no_stop))
         getLogger().info(f"search keywords: {[q for q, _ in queries]}")
-        es_query = build_query([query.search for _, query in queries], res_with_no_stop.highlight, query_text)
-        response = es.search(index="doc_zeta", body=es_query)
-        corrected_query = get_corrected_query(response, query_text)
-        for hit in response["hits"]["hits"]:
-            highlights_res = hit.get("highlight", {})
-            snippets = get_snippets(highlights_res)
-            document_url = get_document_url(hit)
-            results.append({
-                "score": hit["_score"],
-                "date": hit["_source"].get("document_date", "Date not available"),
-                "case_name": hit["_source"].get("case_name", "Case name not available"),
-                "document_url": document_url,
-                "snippets": snippets
-            })
-        previous_queries_encoded = encode_queries(queries)
+        if previous_search is not None:
+            previous_turns = [(text, iter_results(response)) for (text, _), response in zip(queries[:-1], await previous_search)]
+        # A query whose correction is already known doesn't need the suggester run again
+        corrected_query = SPELLCHECK_CACHE.get(query_text.lower())
+        response = await cached_search(es, get_query_body(queries, want_spellcheck=corrected_query is None))
+        if corrected_query is None:
+            corrected_query = get_corrected_query(response, query_text)
+            SPELLCHECK_CACHE.set(query_text.lower(), corrected_query)
+        results = iter_results(response)
+        history_token = await SESSION_STORE.put(queries)
         display_query_text = ", ".join([text for text, _ in queries])
-    return render_template_string(TEMPLATE, results=results, new_query_text="", corrected_query=corrected_query, previous_queries_encoded=previous_queries_encoded, display_query_text=display_query_text)
+    # Streamed so neither the whole page nor every result's dict is held in memory at once
+    page = await make_response(buffered(SEARCH_TEMPLATE.generate_async(results=results, new_query_text="", corrected_query=corrected_query, history_token=history_token, display_query_text=display_query_text, replay=replay, previous_turns=previous_turns)))
+    page.set_etag(SESSION_STORE.etag(etag, history_token))
+    page.headers["Cache-Control"] = SEARCH_CACHE_CONTROL
+    return page
 
 TEMPLATE = """
 <!doctype html>
@@ -343,7 +590,8 @@ TEMPLATE = """
   <h2>Search Elasticsearch</h2>
   <form method="post">
     <input type="text" name="new_query_text" placeholder="Enter search text" value="{{ new_query_text }}">
-    <input type="hidden" name="previous_queries_encoded" value="{{ previous_queries_encoded }}">
+    <input type="hidden" name="history_token" value="{{ history_token }}">
+    <label><input type="checkbox" name="replay" value="all" {% if replay %}checked{% endif %}> Show results for every search</label>
     <input type="submit" value="Search">
   </form>
     {% if display_query_text %}
@@ -363,10 +611,7 @@ TEMPLATE = """
         </a>?
     </p>
     {% endif %}
-  {% if results %}
-    <h3>Results:</h3>
-    <ul>
-    {% for r in results %}
+  {% macro render_result(r) %}
       <li class="result">
         <div><strong>Case Name:</strong> 
             {% if r.document_url %}
@@ -381,13 +626,30 @@ TEMPLATE = """
           <div>{{ snippet|safe }}</div>
         {% endfor %}
       </li>
-    {% endfor %}
+  {% endmacro %}
+  {% for r in results %}
+    {% if loop.first %}
+    <h3>Results:</h3>
+    <ul>
+    {% endif %}
+    {{ render_result(r) }}
+    {% if loop.last %}
     </ul>
-  {% endif %}
+    {% endif %}
+  {% endfor %}
+  {% for text, turn_results in previous_turns %}
+    <h3>Results for: {{ text }}</h3>
+    <ul>
+    {% for r in turn_results %}{{ render_result(r) }}{% endfor %}
+    </ul>
+  {% endfor %}
 </body>
 </html>
 """
 
+# Compiled once at import; render_template_string would re-parse the source on every request
+SEARCH_TEMPLATE = app.jinja_env.from_string(TEMPLATE)
+
 if __name__ == "__main__":
     getLogger().info("Starting App")
     app.run(host='0.0.0.0', port=os.environ.get("PORT") or 5001, debug=True)
\ No newline at end of file
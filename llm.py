@@ -1,7 +1,10 @@
+import logging
 from logging import getLogger
+import hashlib
+import httpx
 import openai
-import ast
-from typing import List, Tuple, Union
+import json
+from typing import Callable, List, Optional, Tuple, Union
 import os
 
 class SearchHighlightResponse:
@@ -16,17 +19,89 @@ class SearchHighlightResponse:
     def from_dict(data: dict):
         return SearchHighlightResponse(search=data["search"], highlight=data["highlight"])
 
+    def to_dict(self) -> dict:
+        return {"search": self.search, "highlight": self.highlight}
+
+# JSON mode: the API only returns syntactically valid JSON objects, so replies no longer fail to parse
+_JSON_OBJECT_FORMAT = {"type": "json_object"}
+
+# Output tolerated after the JSON value closes while waiting for the usage chunk
+_MAX_TRAILING_CHARS = 256
+
+class _JsonEndTracker:
+    """Follows bracket depth across streamed chunks to tell when the top-level JSON value has closed."""
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                self.depth += 1
+            elif ch in "]}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+_openai = None
+
+def get_openai_client() -> openai.AsyncOpenAI:
+    # One client per process so its HTTP/2 connection, TLS session and header table are reused across calls
+    global _openai
+    if _openai is None:
+        _openai = openai.AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=openai.DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=32),
+            ),
+        )
+    return _openai
+
+async def close_openai_client():
+    global _openai
+    if _openai is not None:
+        await _openai.close()
+        _openai = None
+
 class ChatGPTTupleArrayFetcher:
     def __init__(
         self,
         model: str = "gpt-4-turbo",
-        max_retries: int = 3
+        max_retries: int = 3,
+        cache=None
     ):
         self.model = model
-        self.client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        self.client = get_openai_client()
         self.max_retries = max_retries
+        # Any object with async get(key)/set(key, value) holding plain lists/dicts, so it can be
+        # shared out of process; hits rebuild the parsed result and skip the LLM entirely
+        self.cache = cache
+
+    def _cache_key(self, kind: str, user_query: str, system_prompt: str) -> tuple:
+        """Key parsed results by model and prompt too, so editing either doesn't serve stale answers."""
+        return (kind, self.model, user_query, hashlib.sha256(system_prompt.encode()).hexdigest())
 
-    def fetch_array_of_tuples(
+    async def _cache_get(self, key: tuple):
+        return await self.cache.get(key) if self.cache is not None else None
+
+    async def _cache_set(self, key: tuple, value):
+        if self.cache is not None:
+            await self.cache.set(key, value)
+
+    async def fetch_array_of_tuples(
         self,
         user_query: str,
     ) -> Union[List[Tuple[str, int]], None]:
@@ -49,92 +124,117 @@ for example: "denial of sanction after taking cognizance"
 answer will be something like:
 
  [
-  ("denial of sanction", 1),
-  ("denials of sanctions", 2),
-  ("taking cognizance", 1),
-  ("sanction for prosecution", 2),
-  ("cognizance without sanction", 2)
-  ("cognizance of offence", 2),
-  ("refusal to grant sanction", 2),
-  ("absence of sanction", 2),
-  ("invalid sanction", 3),
-  ("requirement of sanction", 3),
-  ("sanction under Section CrPC", 2),
-  ("sanction under  Act", 2),
-  ("bar  taking cognizance", 3)
+  ["denial of sanction", 1],
+  ["denials of sanctions", 2],
+  ["taking cognizance", 1],
+  ["sanction for prosecution", 2],
+  ["cognizance without sanction", 2],
+  ["cognizance of offence", 2],
+  ["refusal to grant sanction", 2],
+  ["absence of sanction", 2],
+  ["invalid sanction", 3],
+  ["requirement of sanction", 3],
+  ["sanction under Section CrPC", 2],
+  ["sanction under  Act", 2],
+  ["bar  taking cognizance", 3]
 ]
 
 Here we are removing stop words and we are adding slop, so you don't need to repeat words with different phrasing unless the word is not a non stop word or an entirely different way of phrasing it.
 
-Only reply just the fixed list of tuple[str, int] in the format like [('text_1', 1), ('text_2', 2)]
+Only reply just the fixed JSON array of [string, integer] pairs in the format like [["text_1", 1], ["text_2", 2]]
 """
 
-        fix_prompt = """Only reply just the fixed list of tuple[str, int] in the format like [('text_1', 1), ('text_2', 2)]"""
+        fix_prompt = """Only reply just the fixed JSON array of [string, integer] pairs in the format like [["text_1", 1], ["text_2", 2]]"""
+
+        cache_key = self._cache_key("tuples", user_query, system_prompt)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return [tuple(pair) for pair in cached]
 
         l = getLogger()
         for attempt in range(self.max_retries):
-            response_text = self._query_chatgpt(system_prompt, f"provide result for: '{user_query}'")
+            response_text = await self._query_chatgpt(system_prompt, f"provide result for: '{user_query}'")
             parsed_array = self._try_parse_tuple_array(response_text)
             if parsed_array is not None:
+                await self._cache_set(cache_key, [list(pair) for pair in parsed_array])
                 return parsed_array
             else:
-                l.info(f"[Attempt {attempt+1}] Invalid tuple array format. Retrying with fix prompt.")
+                l.info("[Attempt %d] Invalid tuple array format. Retrying with fix prompt.", attempt + 1)
                 user_query = f"Fix this output:\n{response_text}"
                 system_prompt = fix_prompt
         l.info("Max retries reached. Failed to get valid tuple array.")
         return None
 
-    def _query_chatgpt(self, system_prompt: str, user_query: str) -> str:
+    async def _query_chatgpt(self, system_prompt: str, user_query: str, response_format: Optional[dict] = None) -> str:
         """Query ChatGPT with system + user messages."""
-        response = self.client.chat.completions.create(
+        response = await self.client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_query}
             ],
-            temperature=0.2
+            temperature=0.2,
+            response_format=response_format if response_format is not None else openai.NOT_GIVEN,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        # Extract response content
-        content = response.choices[0].message.content.strip()
-
-        # Token usage info (if available)
-        usage = getattr(response, "usage", None)
-        prompt_tokens = usage.prompt_tokens if usage else "?"
-        completion_tokens = usage.completion_tokens if usage else "?"
-        total_tokens = usage.total_tokens if usage else "?"
+        # Collect the streamed content up to the end of the JSON value. Reading carries on for the
+        # final usage chunk, but a reply padding on past the value (JSON mode can emit endless
+        # newlines) is cut off after _MAX_TRAILING_CHARS.
+        parts = []
+        usage = None
+        tracker = _JsonEndTracker()
+        complete = False
+        trailing = 0
+        async for chunk in response:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if complete:
+                trailing += len(delta)
+                if trailing > _MAX_TRAILING_CHARS:
+                    await response.close()
+                    break
+            else:
+                parts.append(delta)
+                complete = tracker.feed(delta)
+        content = "".join(parts).strip()
 
-        # Debug output
+        # Debug output, skipped entirely unless debug logging is on
         l = getLogger()
-        l.info(f"user query: {user_query}")
-        l.info(f"input token consumption: {prompt_tokens}")
-        l.info(f"output token consumption: {completion_tokens}")
-        l.info(f"total token consumption: {total_tokens}")
-        l.info("-------LLM Response Start-------")
-        l.info(content)
-        l.info("-------LLM Response End-------")
+        if l.isEnabledFor(logging.DEBUG):
+            l.debug("user query: %s", user_query)
+            l.debug(
+                "token consumption in/out/total=%s/%s/%s",
+                usage.prompt_tokens if usage else "?",
+                usage.completion_tokens if usage else "?",
+                usage.total_tokens if usage else "?",
+            )
+            l.debug("LLM response:\n%s", content)
 
         return content
 
     def _try_parse_tuple_array(self, output: str) -> Union[List[Tuple], None]:
-        """Try to parse the output as a list of tuples using ast.literal_eval."""
+        """Try to parse the output as a JSON array of [str, int] pairs into a list of tuples."""
         l = getLogger()
         try:
-            output = output.replace("\n", "")
-            parsed = ast.literal_eval(output)
-            if isinstance(parsed, list) and all(isinstance(item, tuple) and isinstance(item[0], str) and isinstance(item[1], int) for item in parsed):
-                return parsed
+            parsed = json.loads(output)
+            if isinstance(parsed, list) and all(isinstance(item, list) and len(item) == 2 and isinstance(item[0], str) and isinstance(item[1], int) for item in parsed):
+                return [tuple(item) for item in parsed]
             else:
                 l.info("Parsed result is not a list of tuples.")
                 return None
         except Exception as e:
-            l.info(f"Failed to parse output as Python list of tuples: {e}")
+            l.info("Failed to parse output as JSON list of pairs: %s", e)
             return None
         
     def _try_parse_search_highlight_json(self, output: str) -> SearchHighlightResponse | None:
         """Try to parse json as SearchHighlightResponse"""
         l = getLogger()
         try:
-            parsed = ast.literal_eval(output)
+            parsed = json.loads(output)
             if (
                 isinstance(parsed, dict)
                 and "search" in parsed
@@ -149,14 +249,18 @@ Only reply just the fixed list of tuple[str, int] in the format like [('text_1',
                 l.info("Parsed result is not a SearchHighlightResponse.")
                 return None
         except Exception as e:
-            l.info(f"Failed to parse output as SearchHighlightResponse: {e}")
+            l.info("Failed to parse output as SearchHighlightResponse: %s", e)
             return None
         
-    def fetch_search_highlight(
+    async def fetch_search_highlight(
         self,
-        user_query: str
+        user_query: str,
+        on_llm_request: Optional[Callable[[], None]] = None
     ) -> Union[SearchHighlightResponse, None]:
-        """Main method to fetch SearchHighlight from ChatGPT."""
+        """Main method to fetch SearchHighlight from ChatGPT.
+
+        on_llm_request is called once if the result isn't cached and the LLM is actually queried.
+        """
         system_prompt = """
 You are helping improve a legal document search system that uses keyword-based phrase search with slop.
 
@@ -165,7 +269,7 @@ Given a user's legal query, you need to:
 2. Group those phrases into a 2D array (list of list of strings). Each sublist represents a group of semantically related phrases that can be searched together. All groupings should have atleast one term directly from the search, you can correct spelling mistakes though only if its very evident. Add plurals and different wording within each group.
 3. Additionally, highlight the most critical phrases (from the user query or closely related) in a separate list. Legal terms associated including acts and sections.
 
-Return a **JSON-like Python dictionary** with:
+Return a **JSON object** with:
 - "search": a list of lists of phrases (each phrase is a string).
 - "highlight": a list of key phrases to visually highlight to the user.
 
@@ -220,7 +324,7 @@ Example input query: "defence witness to be treated on par with prosecution witn
 Example output:
 {
     "search": [
-        ["defence witness treated on par prosecution witness", "defence witness equitable treatment prosecution witness", "defence witness equal treatment prosecution witness"],
+        ["defence witness treated on par prosecution witness", "defence witness equitable treatment prosecution witness", "defence witness equal treatment prosecution witness"]
     ],
     "highlight": [
         "witness credibility",
@@ -230,7 +334,7 @@ Example output:
     ]
 }
 
-Only return the Python dictionary in this format. Do not add explanations or extra text.
+Only return the JSON object in this format, using double quotes. Do not add explanations or extra text.
 """
 
         """Example input query: "section 17 from registration act"
@@ -250,7 +354,7 @@ Example output:
         """
 
         fix_prompt = """
-Please fix the format of the output to be a valid Python dictionary with this structure:
+Please fix the format of the output to be a valid JSON object with this structure:
 
 {
   "search": list[list[str]],   # list of lists of strings
@@ -263,17 +367,26 @@ Ensure:
 - Keys must be "search" and "highlight".
 - No trailing commas or syntax errors.
 
-Return only the fixed dictionary.
+Return only the fixed JSON object.
 """
 
+        cache_key = self._cache_key("search_highlight", user_query, system_prompt)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return SearchHighlightResponse.from_dict(cached)
+        if on_llm_request is not None:
+            on_llm_request()
+
         l = getLogger()
         for attempt in range(self.max_retries):
-            response_text = self._query_chatgpt(system_prompt, f"provide result for: '{user_query}'")
+            # With JSON mode the retry only covers a reply with the wrong shape
+            response_text = await self._query_chatgpt(system_prompt, f"provide result for: '{user_query}'", _JSON_OBJECT_FORMAT)
             parsed_search_highlight = self._try_parse_search_highlight_json(response_text)
             if parsed_search_highlight is not None:
+                await self._cache_set(cache_key, parsed_search_highlight.to_dict())
                 return parsed_search_highlight
             else:
-                l.info(f"[Attempt {attempt+1}] Invalid SearchHighlight format. \n{response_text}\n Retrying with fix prompt.")
+                l.info("[Attempt %d] Invalid SearchHighlight format. \n%s\n Retrying with fix prompt.", attempt + 1, response_text)
                 user_query = f"Fix this output:\n{response_text}"
                 system_prompt = fix_prompt
         l.info("Max retries reached. Failed to get valid SearchHighlight.")